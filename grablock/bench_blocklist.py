@@ -0,0 +1,89 @@
+# Benchmark for the blocklist matcher in server.py against a synthetic list.
+# Usage: python grablock/bench_blocklist.py [domain_count] [lookup_count]
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import DomainBlocklist
+
+TLDS = ['com', 'net', 'org', 'link', 'icu', 'pics', 'life', 'online', 'store', 'co.uk']
+
+# URL shapes the matcher has to get right, checked before timing anything
+KNOWN_CASES = [
+    ('grabify.link', True),
+    ('grabify.link/abc?r=https://google.com', True),
+    ('grabify.link?next=//x', True),
+    ('http:grabify.link', True),
+    ('https:\\\\grabify.link/x', True),
+    ('HTTPS://Sub.Grabify.Link./x', True),
+    ('//grabify.link/x', True),
+    ('user@a.b.grabify.link:8080/x', True),
+    ('https://grabify.link\\@google.com/', True),
+    ('https://grabify.link\\.google.com', True),
+    ('https://%67rabify.link/', True),
+    ('https://grabify\u3002link/', True),
+    ('https://GRABIFY\uff0eLINK/', True),
+    ('https://grab\tify.link/', True),
+    ('https://grabify.link%40google.com/', True),  # Invalid host, blocked
+    ('https://google.com/?u=grabify.link', False),
+    ('https://google.com\\?u=grabify.link\\x', False),
+    ('http://[::1]:80/', False),
+    ('notgrabify.link', False),
+]
+
+def check_known_cases():
+    matcher = DomainBlocklist(os.devnull)
+    matcher.domains = DomainBlocklist.parse(['grabify.link'])
+    for url, blocked in KNOWN_CASES:
+        result = matcher.check_url(url)
+        assert result['blocked'] == blocked, f'{url!r}: {result}'
+    print(f"Known cases:     {len(KNOWN_CASES)} passed")
+
+def random_label(rng):
+    return ''.join(rng.choices(string.ascii_lowercase + string.digits, k=rng.randint(4, 12)))
+
+def main():
+    domain_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    lookup_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    rng = random.Random(1234)
+
+    check_known_cases()
+
+    domains = [f'{random_label(rng)}.{rng.choice(TLDS)}' for _ in range(domain_count)]
+
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        f.write('\n'.join(domains))
+        path = f.name
+
+    try:
+        matcher = DomainBlocklist(path)
+        start = time.perf_counter()
+        matcher.reload()
+        load_time = time.perf_counter() - start
+
+        # Half the URLs hit the list through a subdomain, half miss
+        urls = []
+        for i in range(lookup_count):
+            if i % 2:
+                host = f'{random_label(rng)}.{rng.choice(domains)}'
+            else:
+                host = f'{random_label(rng)}.{random_label(rng)}.{rng.choice(TLDS)}'
+            urls.append(f'https://{host}/{random_label(rng)}?id={i}')
+
+        start = time.perf_counter()
+        blocked = sum(1 for url in urls if matcher.check_url(url)['blocked'])
+        check_time = time.perf_counter() - start
+    finally:
+        os.unlink(path)
+
+    print(f"Domains loaded:  {len(matcher.domains)} in {load_time:.2f}s")
+    print(f"URLs checked:    {lookup_count} in {check_time:.2f}s "
+          f"({lookup_count / check_time:,.0f} URLs/s)")
+    print(f"Blocked:         {blocked}")
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,206 @@
-from flask import Flask, request, jsonify, session
+from flask import Blueprint, Flask, current_app, has_app_context, request, jsonify, session, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.security import generate_password_hash, check_password_hash
 import sqlite3
 import json
+import gzip
+import ipaddress
+import os
+import re
+import threading
+import time
+import uuid
+import zlib
+from urllib.parse import unquote, urlsplit
 from datetime import datetime, timedelta
 import secrets
+import sys
+
+# Optional speedups - fall back to the stdlib when these aren't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Full UTS-46 host mapping when available, the stdlib IDNA codec otherwise
+try:
+    import idna
+except ImportError:
+    idna = None
+
 APP_VERSION = "2.0.0"  # Update this when you make breaking changes
-app = Flask(__name__)
-app.secret_key = secrets.token_hex(16)  # Generate a random secret key
+BULK_CHUNK_SIZE = 1000  # Rows per transaction for /admin/bulk
+BULK_MAX_CHUNK_SIZE = 10000
+BLOCKLIST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grablock', 'blocklist.txt')
+BLOCKLIST_CHECK_INTERVAL = 5  # Seconds between blocklist file change checks
+CHECK_URLS_MAX = 10000  # Max URLs per /check_urls request
+COMPRESS_MIN_SIZE = 1024  # Only compress bodies bigger than this (bytes)
+CORS_MAX_AGE = 86400  # Let browsers cache preflight results for a day
+
+# Defaults for create_app(). Any of these can be overridden by a JSON file named in
+# SERVER_CONFIG_FILE, by SERVER_<NAME> environment variables (e.g. SERVER_SHARD_COUNT=4)
+# or by the config dict passed to create_app(), in that order.
+DEFAULT_CONFIG = {
+    'SECRET_KEY': None,  # Random per process when unset - set it when running several workers
+    'SHARD_COUNT': 1,
+    'DB_DIR': '',  # Directory holding users.db / the shard files
+    'BLOCKLIST_PATH': BLOCKLIST_PATH,
+    'BLOCKLIST_CHECK_INTERVAL': BLOCKLIST_CHECK_INTERVAL,
+    'COMPRESS_MIN_SIZE': COMPRESS_MIN_SIZE,
+    'CORS_MAX_AGE': CORS_MAX_AGE,
+    'CATALOG_CACHE_TTL': 30,  # Seconds a cached shop catalog is served; 0 disables the cache
+    'CATALOG_CACHE_SIZE': 1000,  # Max cached catalogs per worker
+    'PREWARM_TOP_SELLERS': 0,  # Catalogs of this many top earners are cached during warm-up
+    'WARM_UP': True,  # Run schema setup, ledger recovery etc. in the background on first request
+}
+
+# Use orjson for jsonify/get_json when it's available
+class FastJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj, option=option).decode('utf-8')
+        except TypeError:
+            # Types orjson doesn't know about go through the default encoder
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is None:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+# Routes are registered on this blueprint and attached to an app by create_app()
+bp = Blueprint('server', __name__)
+
+# CORS headers are the same for every response, so build them once
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type,Authorization,Cookie',
+    'Access-Control-Allow-Methods': 'GET,PUT,POST,DELETE,OPTIONS',
+    'Access-Control-Allow-Credentials': 'true',
+}
+
+# Per-app state, created by create_app() and reachable through app_state()
+class AppState:
+    def __init__(self, app):
+        self.preflight_headers = dict(CORS_HEADERS, **{'Access-Control-Max-Age': str(app.config['CORS_MAX_AGE'])})
+        self.blocklist = DomainBlocklist(app.config['BLOCKLIST_PATH'], app.config['BLOCKLIST_CHECK_INTERVAL'])
+        self.catalog_cache = {}  # username -> (expires_at, items)
+        self.warm_up_lock = threading.Lock()
+        self.warm_up_thread = None
+        self.warm_up_error = None
+        self.ready = threading.Event()
+
+def app_state():
+    return current_app.extensions['server']
+
+# Config lookups that also work outside an app (e.g. the migrate_shards command)
+def setting(name):
+    if has_app_context():
+        return current_app.config[name]
+    return DEFAULT_CONFIG[name]
+
+# Answer CORS preflights before any route or session work happens
+@bp.before_app_request
+def handle_preflight():
+    if request.method == 'OPTIONS':
+        return current_app.response_class(status=204, headers=app_state().preflight_headers)
+
+def compress_response(response):
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    data = response.get_data()
+    if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    # accept_encodings parses q-values, so "gzip;q=0" counts as refused
+    accept_encodings = request.accept_encodings
+    if brotli is not None and accept_encodings['br'] > 0:
+        data = brotli.compress(data, quality=5)
+        encoding = 'br'
+    elif accept_encodings['gzip'] > 0:
+        data = gzip.compress(data, compresslevel=6)
+        encoding = 'gzip'
+    else:
+        return response
+
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
 
 # Add CORS headers to allow cross-origin requests
-@app.after_request
+@bp.after_app_request
 def after_request(response):
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,Cookie')
-    response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
-    response.headers.add('Access-Control-Allow-Credentials', 'true')
-    return response
+    if request.method != 'OPTIONS':
+        response.headers.update(CORS_HEADERS)
+    return compress_response(response)
+
+# Storage - users are spread over SHARD_COUNT SQLite files by a stable hash of
+# their username. Everything a user owns lives on their shard: their users row,
+# shop_items, activity_pings, the purchases they received (pending actions) and
+# the transfer_ledger entries for purchases they made.
+# SHARD_COUNT=1 (the default) keeps everything in the original users.db.
+def shard_count():
+    return max(1, int(setting('SHARD_COUNT')))
+
+def shard_db_path(index, count=None):
+    count = shard_count() if count is None else count
+    if count == 1:
+        name = 'users.db'
+    else:
+        name = f'users-{count}-{index}.db'
+    return os.path.join(setting('DB_DIR'), name)
+
+def shard_for(username, count=None):
+    count = shard_count() if count is None else count
+    return zlib.crc32(username.encode('utf-8')) % count
+
+# Each shard's schema is created the first time this process connects to it
+initialized_shards = set()
+init_lock = threading.Lock()
+
+def connect_shard(index, count=None):
+    path = shard_db_path(index, count)
+    if path not in initialized_shards:
+        with init_lock:
+            if path not in initialized_shards:
+                init_shard(sqlite3.connect(path))
+                initialized_shards.add(path)
+    return sqlite3.connect(path)
+
+def connect_user(username):
+    return connect_shard(shard_for(username))
+
+# Which column decides the shard for each per-user table
+SHARD_OWNER_COLUMNS = {
+    'users': 'username',
+    'shop_items': 'owner_username',
+    'activity_pings': 'username',
+    'purchases': 'target_username',
+    'transfer_ledger': 'buyer_username',
+}
 
 # Database initialization
-def init_db():
-    conn = sqlite3.connect('users.db')
+def init_db(count=None):
+    count = shard_count() if count is None else count
+    for index in range(count):
+        connect_shard(index, count).close()
+    recover_ledger(count)
+
+def init_shard(conn):
     c = conn.cursor()
     
     # Users table - separate coins (spending) from earnings (money earned)
@@ -80,10 +261,79 @@ def init_db():
                   ping_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   FOREIGN KEY (username) REFERENCES users (username))''')
     
+    # Cross-shard purchases - the buyer's shard records the debit here and the
+    # target's shard records the purchase with the same ledger_id
+    c.execute('''CREATE TABLE IF NOT EXISTS transfer_ledger
+                 (id TEXT PRIMARY KEY,
+                  buyer_username TEXT NOT NULL,
+                  target_username TEXT NOT NULL,
+                  item_name TEXT NOT NULL,
+                  price INTEGER NOT NULL,
+                  earnings_cents INTEGER NOT NULL,
+                  state TEXT DEFAULT 'debited',
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    
+    try:
+        c.execute('ALTER TABLE purchases ADD COLUMN ledger_id TEXT DEFAULT NULL')
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_purchases_ledger_id ON purchases (ledger_id)')
+    
+    # Indexes for the per-user lookups every client makes
+    c.execute('CREATE INDEX IF NOT EXISTS idx_shop_items_owner ON shop_items (owner_username, item_name)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_purchases_target ON purchases (target_username, executed)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_activity_pings_user ON activity_pings (username, ping_time)')
+    
     conn.commit()
     conn.close()
 
-@app.route('/register', methods=['POST'])
+# Second half of a cross-shard purchase, safe to run more than once
+def apply_ledger_credit(target_conn, ledger_id, buyer, target, item_name, price, earnings_cents):
+    c = target_conn.cursor()
+    c.execute("""INSERT OR IGNORE INTO purchases 
+                (buyer_username, target_username, item_name, price, ledger_id) 
+                VALUES (?, ?, ?, ?, ?)""", (buyer, target, item_name, price, ledger_id))
+    if c.rowcount == 1:
+        c.execute("UPDATE users SET earnings_cents = earnings_cents + ? WHERE username = ?",
+                 (earnings_cents, target))
+    target_conn.commit()
+
+# Finish (or refund) cross-shard purchases that were debited but never credited,
+# e.g. because the server died between the two commits
+def recover_ledger(count=None):
+    count = shard_count() if count is None else count
+    recovered = 0
+    refunded = 0
+    
+    for index in range(count):
+        conn = connect_shard(index, count)
+        c = conn.cursor()
+        c.execute("""SELECT id, buyer_username, target_username, item_name, price, earnings_cents 
+                    FROM transfer_ledger WHERE state = 'debited'""")
+        for ledger_id, buyer, target, item_name, price, earnings_cents in c.fetchall():
+            target_conn = connect_shard(shard_for(target, count), count)
+            try:
+                tc = target_conn.cursor()
+                tc.execute("SELECT 1 FROM users WHERE username = ?", (target,))
+                if tc.fetchone():
+                    apply_ledger_credit(target_conn, ledger_id, buyer, target, item_name, price, earnings_cents)
+                    state = 'completed'
+                    recovered += 1
+                else:
+                    c.execute("UPDATE users SET coins = coins + ? WHERE username = ?", (price, buyer))
+                    state = 'refunded'
+                    refunded += 1
+            finally:
+                target_conn.close()
+            c.execute("UPDATE transfer_ledger SET state = ? WHERE id = ?", (state, ledger_id))
+            conn.commit()
+        conn.close()
+    
+    if recovered or refunded:
+        print(f"Ledger recovery: {recovered} completed, {refunded} refunded")
+    return {'completed': recovered, 'refunded': refunded}
+
+@bp.route('/register', methods=['POST'])
 def register():
     data = request.get_json()
     username = data.get('username')
@@ -92,7 +342,7 @@ def register():
     if not username or not password:
         return jsonify({'error': 'Username and password required'}), 400
     
-    conn = sqlite3.connect('users.db')
+    conn = connect_user(username)
     c = conn.cursor()
     
     try:
@@ -106,7 +356,7 @@ def register():
     finally:
         conn.close()
 
-@app.route('/login', methods=['POST'])
+@bp.route('/login', methods=['POST'])
 def login():
     data = request.get_json()
     username = data.get('username')
@@ -115,7 +365,7 @@ def login():
     if not username or not password:
         return jsonify({'error': 'Username and password required'}), 400
     
-    conn = sqlite3.connect('users.db')
+    conn = connect_user(username)
     c = conn.cursor()
     c.execute("SELECT password_hash, coins FROM users WHERE username = ?", (username,))
     user = c.fetchone()
@@ -129,19 +379,19 @@ def login():
     else:
         return jsonify({'error': 'Invalid credentials'}), 401
 
-@app.route('/logout', methods=['POST'])
+@bp.route('/logout', methods=['POST'])
 def logout():
     session.pop('username', None)
     return jsonify({'message': 'Logged out successfully'}), 200
 
-@app.route('/profile', methods=['GET'])
+@bp.route('/profile', methods=['GET'])
 def profile():
     print(f"Profile request - Session: {dict(session)}")  # Debug
     if 'username' not in session:
         return jsonify({'error': 'Not logged in'}), 401
     
     username = session['username']
-    conn = sqlite3.connect('users.db')
+    conn = connect_user(username)
     c = conn.cursor()
     c.execute("SELECT coins, earnings_cents FROM users WHERE username = ?", (username,))
     user = c.fetchone()
@@ -157,7 +407,7 @@ def profile():
     else:
         return jsonify({'error': 'User not found'}), 404
 
-@app.route('/search_users', methods=['GET'])
+@bp.route('/search_users', methods=['GET'])
 def search_users():
     if 'username' not in session:
         return jsonify({'error': 'Not logged in'}), 401
@@ -166,16 +416,20 @@ def search_users():
     if not query:
         return jsonify({'users': []}), 200
     
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT username FROM users WHERE username LIKE ? LIMIT 10", 
-             (f'%{query}%',))
-    users = [row[0] for row in c.fetchall()]
-    conn.close()
+    users = []
+    for index in range(shard_count()):
+        conn = connect_shard(index)
+        c = conn.cursor()
+        c.execute("SELECT username FROM users WHERE username LIKE ? LIMIT ?", 
+                 (f'%{query}%', 10 - len(users)))
+        users.extend(row[0] for row in c.fetchall())
+        conn.close()
+        if len(users) >= 10:
+            break
     
     return jsonify({'users': users}), 200
 
-@app.route('/register_items', methods=['POST'])
+@bp.route('/register_items', methods=['POST'])
 def register_items():
     if 'username' not in session:
         return jsonify({'error': 'Not logged in'}), 401
@@ -184,7 +438,7 @@ def register_items():
     username = session['username']
     items = data.get('items', [])
     
-    conn = sqlite3.connect('users.db')
+    conn = connect_user(username)
     c = conn.cursor()
     
     # Clear existing items for this user
@@ -201,14 +455,13 @@ def register_items():
     conn.commit()
     conn.close()
     
+    # Drop this worker's cached copy; other workers catch up within CATALOG_CACHE_TTL
+    app_state().catalog_cache.pop(username, None)
+    
     return jsonify({'message': f'Registered {len(items)} items'}), 200
 
-@app.route('/get_shop_items/<target_username>', methods=['GET'])
-def get_shop_items(target_username):
-    if 'username' not in session:
-        return jsonify({'error': 'Not logged in'}), 401
-    
-    conn = sqlite3.connect('users.db')
+def load_catalog(target_username):
+    conn = connect_user(target_username)
     c = conn.cursor()
     c.execute("""SELECT item_name, item_description, price, item_data 
                 FROM shop_items WHERE owner_username = ?""", (target_username,))
@@ -221,10 +474,39 @@ def get_shop_items(target_username):
             'data': json.loads(row[3]) if row[3] else {}
         })
     conn.close()
+    return items
+
+# Shop catalogs are read far more often than they change, so each worker keeps
+# them for CATALOG_CACHE_TTL seconds. Purchases always re-read the price.
+def get_catalog(target_username):
+    ttl = current_app.config['CATALOG_CACHE_TTL']
+    if ttl <= 0:
+        return load_catalog(target_username)
+    
+    cache = app_state().catalog_cache
+    now = time.monotonic()
+    cached = cache.get(target_username)
+    if cached and cached[0] > now:
+        return cached[1]
+    
+    items = load_catalog(target_username)
+    if len(cache) >= current_app.config['CATALOG_CACHE_SIZE']:
+        # Evict the oldest entry
+        try:
+            cache.pop(next(iter(cache)), None)
+        except (StopIteration, RuntimeError):
+            pass
+    cache[target_username] = (now + ttl, items)
+    return items
+
+@bp.route('/get_shop_items/<target_username>', methods=['GET'])
+def get_shop_items(target_username):
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
     
-    return jsonify({'items': items}), 200
+    return jsonify({'items': get_catalog(target_username)}), 200
 
-@app.route('/purchase', methods=['POST'])
+@bp.route('/purchase', methods=['POST'])
 def purchase():
     if 'username' not in session:
         return jsonify({'error': 'Not logged in'}), 401
@@ -237,7 +519,10 @@ def purchase():
     if not target or not item_name:
         return jsonify({'error': 'Target username and item name required'}), 400
     
-    conn = sqlite3.connect('users.db')
+    # Items and pending actions live on the target's shard, coins on the buyer's
+    buyer_shard = shard_for(buyer)
+    target_shard = shard_for(target)
+    conn = connect_shard(target_shard)
     c = conn.cursor()
     
     # Get item price
@@ -250,50 +535,83 @@ def purchase():
     
     price = item[0]
     
-    # Check buyer's coins
-    c.execute("SELECT coins FROM users WHERE username = ?", (buyer,))
-    buyer_coins = c.fetchone()[0]
+    # Calculate earnings (70% of price, rounded down)
+    earnings_cents = int(price * 0.7)
     
-    if buyer_coins < price:
+    if buyer_shard == target_shard:
+        # Check buyer's coins
+        c.execute("SELECT coins FROM users WHERE username = ?", (buyer,))
+        buyer_coins = c.fetchone()[0]
+        
+        if buyer_coins < price:
+            conn.close()
+            return jsonify({'error': 'Insufficient coins'}), 400
+        
+        # Debug: Print transaction details
+        print(f"Purchase: {buyer} buying {item_name} for {price} coins from {target}")
+        print(f"Buyer had {buyer_coins} coins, will lose {price} coins")
+        print(f"Target will gain {earnings_cents} cents in earnings (70% of {price})")
+        
+        # Process purchase - buyer loses coins, target gains earnings (not coins)
+        c.execute("UPDATE users SET coins = coins - ? WHERE username = ?", (price, buyer))
+        c.execute("UPDATE users SET earnings_cents = earnings_cents + ? WHERE username = ?", (earnings_cents, target))
+        c.execute("""INSERT INTO purchases 
+                    (buyer_username, target_username, item_name, price) 
+                    VALUES (?, ?, ?, ?)""", (buyer, target, item_name, price))
+        
+        # Debug: Check final balances
+        c.execute("SELECT coins, earnings_cents FROM users WHERE username = ?", (buyer,))
+        buyer_final = c.fetchone()
+        c.execute("SELECT coins, earnings_cents FROM users WHERE username = ?", (target,))
+        target_final = c.fetchone()
+        print(f"After purchase - Buyer: {buyer_final[0]} coins, {buyer_final[1]} cents")
+        print(f"After purchase - Target: {target_final[0]} coins, {target_final[1]} cents")
+        
+        conn.commit()
+        conn.close()
+        
+        return jsonify({'message': 'Purchase successful'}), 200
+    
+    # Cross-shard purchase: debit the buyer and write a ledger entry in one
+    # transaction on the buyer's shard, then credit the target on their shard.
+    # If the credit doesn't happen, recover_ledger() finishes it later.
+    buyer_conn = connect_shard(buyer_shard)
+    bc = buyer_conn.cursor()
+    bc.execute("UPDATE users SET coins = coins - ? WHERE username = ? AND coins >= ?", 
+              (price, buyer, price))
+    if bc.rowcount != 1:
+        buyer_conn.close()
         conn.close()
         return jsonify({'error': 'Insufficient coins'}), 400
     
-    # Calculate earnings (70% of price, rounded down)
-    earnings_cents = int(price * 0.7)
+    ledger_id = uuid.uuid4().hex
+    bc.execute("""INSERT INTO transfer_ledger 
+                 (id, buyer_username, target_username, item_name, price, earnings_cents) 
+                 VALUES (?, ?, ?, ?, ?, ?)""", 
+              (ledger_id, buyer, target, item_name, price, earnings_cents))
+    buyer_conn.commit()
     
-    # Debug: Print transaction details
-    print(f"Purchase: {buyer} buying {item_name} for {price} coins from {target}")
-    print(f"Buyer had {buyer_coins} coins, will lose {price} coins")
-    print(f"Target will gain {earnings_cents} cents in earnings (70% of {price})")
-    
-    # Process purchase - buyer loses coins, target gains earnings (not coins)
-    c.execute("UPDATE users SET coins = coins - ? WHERE username = ?", (price, buyer))
-    c.execute("UPDATE users SET earnings_cents = earnings_cents + ? WHERE username = ?", (earnings_cents, target))
-    c.execute("""INSERT INTO purchases 
-                (buyer_username, target_username, item_name, price) 
-                VALUES (?, ?, ?, ?)""", (buyer, target, item_name, price))
-    
-    # Debug: Check final balances
-    c.execute("SELECT coins, earnings_cents FROM users WHERE username = ?", (buyer,))
-    buyer_final = c.fetchone()
-    c.execute("SELECT coins, earnings_cents FROM users WHERE username = ?", (target,))
-    target_final = c.fetchone()
-    print(f"After purchase - Buyer: {buyer_final[0]} coins, {buyer_final[1]} cents")
-    print(f"After purchase - Target: {target_final[0]} coins, {target_final[1]} cents")
+    print(f"Purchase: {buyer} buying {item_name} for {price} coins from {target} (ledger {ledger_id})")
     
-    conn.commit()
+    try:
+        apply_ledger_credit(conn, ledger_id, buyer, target, item_name, price, earnings_cents)
+    except sqlite3.Error as e:
+        print(f"Ledger {ledger_id} credit failed, will retry on recovery: {e}")
+        buyer_conn.close()
+        conn.close()
+        return jsonify({'message': 'Purchase accepted', 'pending': True}), 202
+    
+    bc.execute("UPDATE transfer_ledger SET state = 'completed' WHERE id = ?", (ledger_id,))
+    buyer_conn.commit()
+    buyer_conn.close()
     conn.close()
     
     return jsonify({'message': 'Purchase successful'}), 200
 
-@app.route('/get_pending_actions', methods=['GET'])
-def get_pending_actions():
-    if 'username' not in session:
-        return jsonify({'error': 'Not logged in'}), 401
-    
-    username = session['username']
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
+# The per-user operations below take a cursor on the user's shard and return
+# (body, status) without committing, so /sync can run several of them in one
+# transaction. Failed checks return before writing anything.
+def fetch_pending_actions(c, username):
     c.execute("""SELECT id, buyer_username, item_name, price, purchase_time 
                 FROM purchases 
                 WHERE target_username = ? AND executed = FALSE
@@ -309,38 +627,14 @@ def get_pending_actions():
             'purchase_time': row[4]
         })
     
-    conn.close()
-    return jsonify({'actions': actions}), 200
+    return {'actions': actions}, 200
 
-@app.route('/mark_action_executed', methods=['POST'])
-def mark_action_executed():
-    if 'username' not in session:
-        return jsonify({'error': 'Not logged in'}), 401
-    
-    data = request.get_json()
-    action_id = data.get('action_id')
-    username = session['username']
-    
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
+def set_action_executed(c, username, action_id):
     c.execute("UPDATE purchases SET executed = TRUE WHERE id = ? AND target_username = ?", 
              (action_id, username))
-    conn.commit()
-    conn.close()
-    
-    return jsonify({'message': 'Action marked as executed'}), 200
+    return {'message': 'Action marked as executed'}, 200
 
-@app.route('/activity_ping', methods=['POST'])
-def activity_ping():
-    if 'username' not in session:
-        return jsonify({'error': 'Not logged in'}), 401
-    
-    username = session['username']
-    current_time = datetime.now()
-    
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    
+def record_activity_ping(c, username, current_time):
     # Check last ping time (must be at least 5 minutes ago)
     c.execute("""SELECT ping_time FROM activity_pings 
                 WHERE username = ? 
@@ -351,8 +645,7 @@ def activity_ping():
         last_ping_time = datetime.fromisoformat(last_ping[0])
         time_diff = current_time - last_ping_time
         if time_diff.total_seconds() < 300:  # 5 minutes = 300 seconds
-            conn.close()
-            return jsonify({'error': 'Must wait 5 minutes between pings'}), 429
+            return {'error': 'Must wait 5 minutes between pings'}, 429
     
     # Record the ping
     c.execute("INSERT INTO activity_pings (username, ping_time) VALUES (?, ?)",
@@ -371,60 +664,98 @@ def activity_ping():
         c.execute("UPDATE users SET coins = coins + 1 WHERE username = ?", (username,))
         coins_earned = 1
     
-    conn.commit()
-    conn.close()
-    
-    return jsonify({
+    return {
         'message': 'Ping recorded',
         'ping_count': ping_count,
         'coins_earned': coins_earned
-    }), 200
+    }, 200
+
+@bp.route('/get_pending_actions', methods=['GET'])
+def get_pending_actions():
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    username = session['username']
+    conn = connect_user(username)
+    body, status = fetch_pending_actions(conn.cursor(), username)
+    conn.close()
+    return jsonify(body), status
+
+@bp.route('/mark_action_executed', methods=['POST'])
+def mark_action_executed():
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    data = request.get_json()
+    action_id = data.get('action_id')
+    username = session['username']
+    
+    conn = connect_user(username)
+    body, status = set_action_executed(conn.cursor(), username, action_id)
+    conn.commit()
+    conn.close()
+    
+    return jsonify(body), status
+
+@bp.route('/activity_ping', methods=['POST'])
+def activity_ping():
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    username = session['username']
+    current_time = datetime.now()
+    
+    conn = connect_user(username)
+    body, status = record_activity_ping(conn.cursor(), username, current_time)
+    if status == 200:
+        conn.commit()
+    conn.close()
+    
+    return jsonify(body), status
 
 # Admin endpoints (basic authentication for demo - you should add proper admin auth)
-@app.route('/admin/stats', methods=['GET'])
+@bp.route('/admin/stats', methods=['GET'])
 def admin_stats():
     # Simple admin check - in production, use proper authentication
     admin_key = request.headers.get('Admin-Key')
     if admin_key != 'your_admin_key_here':  # Change this to a secure key
         return jsonify({'error': 'Unauthorized'}), 401
     
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    
-    # Get total coins in system
-    c.execute("SELECT SUM(coins) FROM users")
-    total_coins = c.fetchone()[0] or 0
-    
-    # Get total USD earnings (70% of all executed purchases)
-    c.execute("SELECT SUM(price) FROM purchases WHERE executed = TRUE")
-    total_sales = c.fetchone()[0] or 0
-    total_usd_earnings = (total_sales * 0.7) / 100.0  # Convert to dollars
-    
-    # Get user count
-    c.execute("SELECT COUNT(*) FROM users")
-    user_count = c.fetchone()[0]
-    
-    # Get top earners
-    c.execute("""SELECT u.username, u.coins, u.earnings_cents,
-                       CAST(u.earnings_cents / 100.0 AS REAL) as usd_earnings
-                FROM users u
-                ORDER BY u.earnings_cents DESC
-                LIMIT 10""")
+    total_coins = 0
+    user_count = 0
+    total_earnings_cents = 0
     top_earners = []
-    for row in c.fetchall():
-        top_earners.append({
-            'username': row[0],
-            'coins': row[1],
-            'earnings_cents': row[2],
-            'usd_earnings': row[3]
-        })
     
-    # Get total USD earnings
-    c.execute("SELECT SUM(earnings_cents) FROM users")
-    total_earnings_cents = c.fetchone()[0] or 0
-    total_usd_earnings = total_earnings_cents / 100.0
+    for index in range(shard_count()):
+        conn = connect_shard(index)
+        c = conn.cursor()
+        
+        # Get total coins, user count and total earnings in one pass
+        c.execute("SELECT SUM(coins), COUNT(*), SUM(earnings_cents) FROM users")
+        shard_coins, shard_users, shard_earnings = c.fetchone()
+        total_coins += shard_coins or 0
+        user_count += shard_users
+        total_earnings_cents += shard_earnings or 0
+        
+        # Get top earners - the overall top 10 is within each shard's top 10
+        c.execute("""SELECT u.username, u.coins, u.earnings_cents,
+                           CAST(u.earnings_cents / 100.0 AS REAL) as usd_earnings
+                    FROM users u
+                    ORDER BY u.earnings_cents DESC
+                    LIMIT 10""")
+        for row in c.fetchall():
+            top_earners.append({
+                'username': row[0],
+                'coins': row[1],
+                'earnings_cents': row[2],
+                'usd_earnings': row[3]
+            })
+        
+        conn.close()
     
-    conn.close()
+    top_earners.sort(key=lambda user: user['earnings_cents'], reverse=True)
+    top_earners = top_earners[:10]
+    total_usd_earnings = total_earnings_cents / 100.0
     
     return jsonify({
         'total_coins': total_coins,
@@ -433,7 +764,7 @@ def admin_stats():
         'top_earners': top_earners
     }), 200
 
-@app.route('/admin/add_coins', methods=['POST'])
+@bp.route('/admin/add_coins', methods=['POST'])
 def admin_add_coins():
     # Simple admin check - in production, use proper authentication
     admin_key = request.headers.get('Admin-Key')
@@ -447,7 +778,7 @@ def admin_add_coins():
     if not username or coins_to_add <= 0:
         return jsonify({'error': 'Valid username and positive coin amount required'}), 400
     
-    conn = sqlite3.connect('users.db')
+    conn = connect_user(username)
     c = conn.cursor()
     
     # Check if user exists
@@ -472,7 +803,12 @@ def admin_add_coins():
         'new_balance': new_balance
     }), 200
 
-@app.route('/save_passive_progress', methods=['POST'])
+def store_passive_progress(c, username, passive_progress):
+    c.execute("UPDATE users SET passive_progress = ? WHERE username = ?", 
+             (passive_progress, username))
+    return {'message': 'Passive progress saved'}, 200
+
+@bp.route('/save_passive_progress', methods=['POST'])
 def save_passive_progress():
     if 'username' not in session:
         return jsonify({'error': 'Not logged in'}), 401
@@ -481,22 +817,20 @@ def save_passive_progress():
     username = session['username']
     passive_progress = data.get('passive_progress')
     
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("UPDATE users SET passive_progress = ? WHERE username = ?", 
-             (passive_progress, username))
+    conn = connect_user(username)
+    body, status = store_passive_progress(conn.cursor(), username, passive_progress)
     conn.commit()
     conn.close()
     
-    return jsonify({'message': 'Passive progress saved'}), 200
+    return jsonify(body), status
 
-@app.route('/load_passive_progress', methods=['GET'])
+@bp.route('/load_passive_progress', methods=['GET'])
 def load_passive_progress():
     if 'username' not in session:
         return jsonify({'error': 'Not logged in'}), 401
     
     username = session['username']
-    conn = sqlite3.connect('users.db')
+    conn = connect_user(username)
     c = conn.cursor()
     c.execute("SELECT passive_progress FROM users WHERE username = ?", (username,))
     result = c.fetchone()
@@ -507,24 +841,13 @@ def load_passive_progress():
     else:
         return jsonify({'progress': None}), 200
 
-@app.route('/award_passive_coin', methods=['POST'])
-def award_passive_coin():
-    if 'username' not in session:
-        return jsonify({'error': 'Not logged in'}), 401
-    
-    username = session['username']
-    current_time = datetime.now()
-    
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    
+def award_passive(c, username, current_time):
     # Check last passive award time to prevent abuse
     c.execute("SELECT last_passive_award, coins FROM users WHERE username = ?", (username,))
     user = c.fetchone()
     
     if not user:
-        conn.close()
-        return jsonify({'error': 'User not found'}), 404
+        return {'error': 'User not found'}, 404
     
     last_award_time = user[0]
     current_coins = user[1]
@@ -534,11 +857,10 @@ def award_passive_coin():
         last_award = datetime.fromisoformat(last_award_time)
         time_diff = current_time - last_award
         if time_diff.total_seconds() < 295:  # 5 minutes - 5 seconds
-            conn.close()
-            return jsonify({
+            return {
                 'error': 'Passive coin awarded too quickly', 
                 'wait_seconds': 25 - int(time_diff.total_seconds())
-            }), 429
+            }, 429
     
     # Award the coin
     c.execute("UPDATE users SET coins = coins + 1, last_passive_award = ? WHERE username = ?", 
@@ -548,19 +870,32 @@ def award_passive_coin():
     c.execute("SELECT coins FROM users WHERE username = ?", (username,))
     new_balance = c.fetchone()[0]
     
-    conn.commit()
-    conn.close()
-    
     print(f"Passive coin awarded to {username}: {current_coins} -> {new_balance}")
     
-    return jsonify({
+    return {
         'message': 'Passive coin awarded',
         'new_balance': new_balance
-    }), 200
+    }, 200
+
+@bp.route('/award_passive_coin', methods=['POST'])
+def award_passive_coin():
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    username = session['username']
+    current_time = datetime.now()
+    
+    conn = connect_user(username)
+    body, status = award_passive(conn.cursor(), username, current_time)
+    if status == 200:
+        conn.commit()
+    conn.close()
+    
+    return jsonify(body), status
 
 # Add this endpoint to your Flask server (server.py)
 
-@app.route('/admin/reset_passive', methods=['POST'])
+@bp.route('/admin/reset_passive', methods=['POST'])
 def admin_reset_passive():
     # Simple admin check - in production, use proper authentication
     admin_key = request.headers.get('Admin-Key')
@@ -570,27 +905,43 @@ def admin_reset_passive():
     data = request.get_json()
     username = data.get('username')
     reset_all = data.get('reset_all', False)  # Option to reset all users
-    
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
+    include_users = data.get('include_users') is True  # Full user list is opt-in
     
     if reset_all:
-        # Reset passive progress for all users
-        c.execute("SELECT username FROM users WHERE passive_progress IS NOT NULL")
-        affected_users = [row[0] for row in c.fetchall()]
-        
-        # Clear passive progress and last award time for all users
-        c.execute("UPDATE users SET passive_progress = NULL, last_passive_award = NULL")
-        conn.commit()
-        conn.close()
+        affected_users = []
+        affected_count = 0
+        for index in range(shard_count()):
+            conn = connect_shard(index)
+            c = conn.cursor()
+            
+            # Reset passive progress for all users
+            if include_users:
+                c.execute("SELECT username FROM users WHERE passive_progress IS NOT NULL")
+                shard_users = [row[0] for row in c.fetchall()]
+                affected_users.extend(shard_users)
+                affected_count += len(shard_users)
+            else:
+                c.execute("SELECT COUNT(*) FROM users WHERE passive_progress IS NOT NULL")
+                affected_count += c.fetchone()[0]
+            
+            # Clear passive progress and last award time for all users
+            c.execute("UPDATE users SET passive_progress = NULL, last_passive_award = NULL")
+            conn.commit()
+            conn.close()
         
-        return jsonify({
-            'message': f'Reset passive coin progress for {len(affected_users)} users',
-            'users_affected': affected_users,
+        result = {
+            'message': f'Reset passive coin progress for {affected_count} users',
+            'users_affected_count': affected_count,
             'action': 'All passive progress cleared - users will start fresh cycle on next login'
-        }), 200
+        }
+        if include_users:
+            result['users_affected'] = affected_users
+        return jsonify(result), 200
     
     elif username:
+        conn = connect_user(username)
+        c = conn.cursor()
+        
         # Reset passive progress for specific user
         # Check if user exists
         c.execute("SELECT passive_progress, last_passive_award FROM users WHERE username = ?", (username,))
@@ -615,11 +966,10 @@ def admin_reset_passive():
         }), 200
     
     else:
-        conn.close()
         return jsonify({'error': 'Must provide username or set reset_all=true'}), 400
 
 # Optional: Admin endpoint to check passive coin status
-@app.route('/admin/passive_status', methods=['GET'])
+@bp.route('/admin/passive_status', methods=['GET'])
 def admin_passive_status():
     # Simple admin check - in production, use proper authentication
     admin_key = request.headers.get('Admin-Key')
@@ -628,10 +978,10 @@ def admin_passive_status():
     
     username = request.args.get('username')
     
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    
     if username:
+        conn = connect_user(username)
+        c = conn.cursor()
+        
         # Get specific user's passive status
         c.execute("SELECT username, passive_progress, last_passive_award FROM users WHERE username = ?", (username,))
         user = c.fetchone()
@@ -664,31 +1014,38 @@ def admin_passive_status():
         return jsonify(status), 200
     
     else:
-        # Get overview of all users' passive status
-        c.execute("""SELECT username, 
-                           CASE WHEN passive_progress IS NOT NULL THEN 1 ELSE 0 END as has_progress,
-                           CASE WHEN last_passive_award IS NOT NULL THEN 1 ELSE 0 END as has_award_time
-                    FROM users 
-                    ORDER BY username""")
-        
         users = []
         total_with_progress = 0
         total_with_award_time = 0
         
-        for row in c.fetchall():
-            user_status = {
-                'username': row[0],
-                'has_passive_progress': bool(row[1]),
-                'has_last_award_time': bool(row[2])
-            }
-            users.append(user_status)
+        for index in range(shard_count()):
+            conn = connect_shard(index)
+            c = conn.cursor()
             
-            if row[1]:
-                total_with_progress += 1
-            if row[2]:
-                total_with_award_time += 1
+            # Get overview of all users' passive status
+            c.execute("""SELECT username, 
+                               CASE WHEN passive_progress IS NOT NULL THEN 1 ELSE 0 END as has_progress,
+                               CASE WHEN last_passive_award IS NOT NULL THEN 1 ELSE 0 END as has_award_time
+                        FROM users 
+                        ORDER BY username""")
+            
+            for row in c.fetchall():
+                user_status = {
+                    'username': row[0],
+                    'has_passive_progress': bool(row[1]),
+                    'has_last_award_time': bool(row[2])
+                }
+                users.append(user_status)
+                
+                if row[1]:
+                    total_with_progress += 1
+                if row[2]:
+                    total_with_award_time += 1
+            
+            conn.close()
         
-        conn.close()
+        if shard_count() > 1:
+            users.sort(key=lambda user: user['username'])
         
         return jsonify({
             'total_users': len(users),
@@ -697,57 +1054,59 @@ def admin_passive_status():
             'users': users
         }), 200
 
-@app.route('/admin/fix_passive_corruption', methods=['POST'])
+@bp.route('/admin/fix_passive_corruption', methods=['POST'])
 def admin_fix_passive_corruption():
     # Simple admin check - in production, use proper authentication
     admin_key = request.headers.get('Admin-Key')
     if admin_key != 'your_admin_key_here':  # Change this to a secure key
         return jsonify({'error': 'Unauthorized'}), 401
     
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    
     # Find users with corrupted passive progress
-    c.execute("SELECT username, passive_progress FROM users WHERE passive_progress IS NOT NULL")
     corrupted_users = []
-    
-    for row in c.fetchall():
-        username, progress_data = row
-        is_corrupted = False
+    for index in range(shard_count()):
+        conn = connect_shard(index)
+        c = conn.cursor()
+        c.execute("SELECT username, passive_progress FROM users WHERE passive_progress IS NOT NULL")
+        shard_corrupted = []
         
-        try:
-            import json
-            progress = json.loads(progress_data)
+        for row in c.fetchall():
+            username, progress_data = row
+            is_corrupted = False
             
-            # Check if the data structure is valid
-            if not isinstance(progress, dict):
-                is_corrupted = True
-            elif 'passiveCoins' not in progress or 'currentGrowingCoin' not in progress:
-                is_corrupted = True
-            elif not isinstance(progress.get('passiveCoins'), list):
-                is_corrupted = True
-            elif not isinstance(progress.get('currentGrowingCoin'), int):
+            try:
+                import json
+                progress = json.loads(progress_data)
+                
+                # Check if the data structure is valid
+                if not isinstance(progress, dict):
+                    is_corrupted = True
+                elif 'passiveCoins' not in progress or 'currentGrowingCoin' not in progress:
+                    is_corrupted = True
+                elif not isinstance(progress.get('passiveCoins'), list):
+                    is_corrupted = True
+                elif not isinstance(progress.get('currentGrowingCoin'), int):
+                    is_corrupted = True
+                else:
+                    # Check each coin structure
+                    for coin in progress.get('passiveCoins', []):
+                        if not isinstance(coin, dict) or 'progress' not in coin or 'isComplete' not in coin:
+                            is_corrupted = True
+                            break
+                            
+            except (json.JSONDecodeError, TypeError, AttributeError):
                 is_corrupted = True
-            else:
-                # Check each coin structure
-                for coin in progress.get('passiveCoins', []):
-                    if not isinstance(coin, dict) or 'progress' not in coin or 'isComplete' not in coin:
-                        is_corrupted = True
-                        break
-                        
-        except (json.JSONDecodeError, TypeError, AttributeError):
-            is_corrupted = True
+            
+            if is_corrupted:
+                shard_corrupted.append(username)
         
-        if is_corrupted:
-            corrupted_users.append(username)
-    
-    # Clear corrupted data
-    if corrupted_users:
-        placeholders = ','.join(['?' for _ in corrupted_users])
-        c.execute(f"UPDATE users SET passive_progress = NULL, last_passive_award = NULL WHERE username IN ({placeholders})", corrupted_users)
-        conn.commit()
-    
-    conn.close()
+        # Clear corrupted data
+        if shard_corrupted:
+            placeholders = ','.join(['?' for _ in shard_corrupted])
+            c.execute(f"UPDATE users SET passive_progress = NULL, last_passive_award = NULL WHERE username IN ({placeholders})", shard_corrupted)
+            conn.commit()
+        
+        conn.close()
+        corrupted_users.extend(shard_corrupted)
     
     return jsonify({
         'message': f'Fixed passive coin corruption for {len(corrupted_users)} users',
@@ -755,23 +1114,597 @@ def admin_fix_passive_corruption():
         'action': 'Corrupted passive progress cleared - users will start fresh on next login'
     }), 200
 
-@app.route('/version_check', methods=['POST'])
-def version_check():
-    data = request.get_json()
-    client_version = data.get('version', '')
+@bp.route('/admin/recover_ledger', methods=['POST'])
+def admin_recover_ledger():
+    # Simple admin check - in production, use proper authentication
+    admin_key = request.headers.get('Admin-Key')
+    if admin_key != 'your_admin_key_here':  # Change this to a secure key
+        return jsonify({'error': 'Unauthorized'}), 401
     
+    result = recover_ledger()
+    return jsonify({
+        'message': f"Settled {result['completed'] + result['refunded']} cross-shard purchases",
+        'completed': result['completed'],
+        'refunded': result['refunded']
+    }), 200
+
+# Bulk admin operations - grants and passive resets applied in chunked transactions.
+# Accepts either a JSON body:
+#   {"grants": [{"username": "bob", "delta": 5}, ["alice", 10]], "resets": ["carol"]}
+# or an NDJSON body / uploaded file (field "file"), one operation per line:
+#   {"op": "grant", "username": "bob", "delta": 5}
+#   {"op": "reset", "username": "carol"}
+# Results are streamed back as NDJSON, one line per chunk plus a final summary.
+# Only counts are returned unless include_users is set.
+def parse_bulk_op(op):
+    if not isinstance(op, dict):
+        return None
+    kind = op.get('op')
+    username = op.get('username')
+    delta = op.get('delta')
+    
+    if not isinstance(username, str) or not username:
+        return None
+    if kind == 'grant':
+        if isinstance(delta, bool) or not isinstance(delta, int) or delta == 0:
+            return None
+        return ('grant', username, delta)
+    if kind == 'reset':
+        return ('reset', username, None)
+    return None
+
+def iter_bulk_ops(data):
+    for grant in data.get('grants') or []:
+        if isinstance(grant, (list, tuple)) and len(grant) == 2:
+            grant = {'username': grant[0], 'delta': grant[1]}
+        if isinstance(grant, dict):
+            grant = dict(grant, op='grant')
+        yield parse_bulk_op(grant)
+    
+    for reset in data.get('resets') or []:
+        if isinstance(reset, str):
+            reset = {'username': reset}
+        if isinstance(reset, dict):
+            reset = dict(reset, op='reset')
+        yield parse_bulk_op(reset)
+
+def iter_bulk_ndjson(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield parse_bulk_op(json.loads(line))
+        except ValueError:
+            yield None
+
+def find_missing_users(c, usernames):
+    missing = set(usernames)
+    usernames = list(missing)
+    # Stay under SQLite's bound-parameter limit
+    for i in range(0, len(usernames), 500):
+        batch = usernames[i:i + 500]
+        placeholders = ','.join(['?' for _ in batch])
+        c.execute(f"SELECT username FROM users WHERE username IN ({placeholders})", batch)
+        missing.difference_update(row[0] for row in c.fetchall())
+    return sorted(missing)
+
+# conns maps shard index -> open connection and is filled in as shards are touched.
+# Each shard's part of the chunk is committed as its own transaction.
+def apply_bulk_chunk(conns, chunk_number, grants, resets, invalid, include_users):
+    shard_grants = {}
+    shard_resets = {}
+    for username, delta in grants:
+        shard_grants.setdefault(shard_for(username), []).append((delta, username))
+    for username in resets:
+        shard_resets.setdefault(shard_for(username), []).append((username,))
+    
+    grants_applied = 0
+    resets_applied = 0
+    missing_users = []
+    
+    for index in set(shard_grants) | set(shard_resets):
+        if index not in conns:
+            conns[index] = connect_shard(index)
+        conn = conns[index]
+        c = conn.cursor()
+        
+        # Coins never go below zero when a negative delta is granted
+        if index in shard_grants:
+            c.executemany("UPDATE users SET coins = MAX(coins + ?, 0) WHERE username = ?",
+                          shard_grants[index])
+            grants_applied += c.rowcount
+        
+        if index in shard_resets:
+            c.executemany("UPDATE users SET passive_progress = NULL, last_passive_award = NULL WHERE username = ?",
+                          shard_resets[index])
+            resets_applied += c.rowcount
+        
+        conn.commit()
+        
+        if include_users:
+            missing_users.extend(find_missing_users(
+                c, [username for _, username in shard_grants.get(index, [])] +
+                   [username for (username,) in shard_resets.get(index, [])]))
+    
+    result = {
+        'chunk': chunk_number,
+        'grants_applied': grants_applied,
+        'grants_missing': len(grants) - grants_applied,
+        'resets_applied': resets_applied,
+        'resets_missing': len(resets) - resets_applied,
+        'invalid': invalid
+    }
+    if include_users:
+        result['grant_users'] = [username for username, _ in grants]
+        result['reset_users'] = resets
+        result['missing_users'] = sorted(missing_users)
+    return result
+
+@bp.route('/admin/bulk', methods=['POST'])
+def admin_bulk():
+    # Simple admin check - in production, use proper authentication
+    admin_key = request.headers.get('Admin-Key')
+    if admin_key != 'your_admin_key_here':  # Change this to a secure key
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    include_users = request.args.get('include_users', '').lower() in ('1', 'true', 'yes')
+    try:
+        chunk_size = int(request.args.get('chunk_size', BULK_CHUNK_SIZE))
+    except ValueError:
+        return jsonify({'error': 'chunk_size must be an integer'}), 400
+    chunk_size = max(1, min(chunk_size, BULK_MAX_CHUNK_SIZE))
+    
+    if 'file' in request.files:
+        # Uploaded files are closed with the request, so read them up front
+        ops = iter_bulk_ndjson(request.files['file'].read().splitlines())
+    elif request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        ops = iter_bulk_ndjson(request.stream)
+    else:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Expected a JSON object or an NDJSON body'}), 400
+        # Checked here because errors inside the stream can't change the status code
+        if any(data.get(key) is not None and not isinstance(data[key], list)
+               for key in ('grants', 'resets')):
+            return jsonify({'error': 'grants and resets must be lists'}), 400
+        include_users = include_users or data.get('include_users') is True
+        ops = iter_bulk_ops(data)
+    
+    def generate():
+        conns = {}
+        totals = {'chunks': 0, 'grants_applied': 0, 'grants_missing': 0,
+                  'resets_applied': 0, 'resets_missing': 0, 'invalid': 0}
+        grants, resets, invalid, pending = [], [], 0, 0
+        
+        def flush():
+            result = apply_bulk_chunk(conns, totals['chunks'], grants, resets, invalid, include_users)
+            totals['chunks'] += 1
+            for key in ('grants_applied', 'grants_missing', 'resets_applied', 'resets_missing', 'invalid'):
+                totals[key] += result[key]
+            return json.dumps(result) + '\n'
+        
+        try:
+            for op in ops:
+                if op is None:
+                    invalid += 1
+                elif op[0] == 'grant':
+                    grants.append((op[1], op[2]))
+                else:
+                    resets.append(op[1])
+                pending += 1
+                
+                if pending >= chunk_size:
+                    yield flush()
+                    grants, resets, invalid, pending = [], [], 0, 0
+            
+            if pending:
+                yield flush()
+        finally:
+            for conn in conns.values():
+                conn.close()
+        
+        print(f"Bulk admin run: {totals}")
+        yield json.dumps(dict(totals, done=True)) + '\n'
+    
+    return current_app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# IP-grabber domain blocklist (grablock/blocklist.txt).
+# Domains live in a set and a host is checked by stripping one label at a time,
+# so "a.b.grabify.link" matches "grabify.link" in O(labels) lookups.
+# The file is re-read in the background of normal requests when its mtime changes;
+# lookups keep using the old set until the new one is swapped in.
+SCHEME_RE = re.compile(r'^[a-z][a-z0-9+.-]*://', re.IGNORECASE)
+# Browsers accept any number of slashes (or backslashes) after these schemes,
+# so "http:grabify.link" and "https:\\grabify.link" both open grabify.link
+SPECIAL_SCHEME_RE = re.compile(r'^(https?|ftp|wss?):[/\\]*', re.IGNORECASE)
+HOST_RE = re.compile(r'^[a-z0-9_.-]+$')
+
+# Turn a host into what a browser would actually connect to: percent-decoded,
+# IDNA-mapped ("grabify\u3002link" -> "grabify.link") and lowercased.
+# Returns None when a browser would reject the host.
+def normalize_host(host):
+    try:
+        host = unquote(host, errors='strict')
+        if ':' in host or host.replace('.', '').isdigit():
+            try:
+                return ipaddress.ip_address(host).compressed
+            except ValueError:
+                pass
+        if idna is not None:
+            host = idna.uts46_remap(host, std3_rules=False, transitional=False)
+        host = host.encode('idna').decode('ascii').lower().rstrip('.')
+    except UnicodeError:
+        return None
+    if not HOST_RE.match(host):
+        return None
+    return host
+
+# Follows the WHATWG URL rules browsers use for http(s)/ws(s)/ftp links, so the
+# host reported here is the one the link really opens. Returns None when no
+# valid host can be found.
+def extract_host(url):
+    url = re.sub(r'[\t\n\r]', '', url).strip()  # Browsers drop these anywhere in a URL
+    if SPECIAL_SCHEME_RE.match(url) or not SCHEME_RE.match(url):
+        # "\" means "/" everywhere before the query, so "https://grabify.link\@google.com"
+        # opens grabify.link
+        end = re.search(r'[?#]|$', url).start()
+        url = url[:end].replace('\\', '/') + url[end:]
+        url = SPECIAL_SCHEME_RE.sub(r'\1://', url)
+        if not SCHEME_RE.match(url) and not url.startswith('//'):
+            # Bare links like "grabify.link/abc?r=https://google.com" - a "//" later
+            # in the path or query doesn't make it a full URL
+            url = '//' + url
+    try:
+        host = urlsplit(url).hostname
+    except ValueError:
+        return None
+    if not host:
+        return None
+    return normalize_host(host)
+
+class DomainBlocklist:
+    def __init__(self, path, check_interval=BLOCKLIST_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.domains = frozenset()
+        self.mtime = None
+        self.last_check = 0
+        self.reload_lock = threading.Lock()
+
+    @staticmethod
+    def parse(lines):
+        domains = set()
+        for line in lines:
+            line = line.split('#', 1)[0].strip().lower().rstrip('.')
+            if line.startswith('*.'):
+                line = line[2:]
+            if line:
+                domains.add(line)
+        return frozenset(domains)
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+            with open(self.path, encoding='utf-8') as f:
+                domains = self.parse(f)
+        except OSError as e:
+            print(f"Could not load blocklist {self.path}: {e}")
+            return False
+        
+        self.domains = domains  # Single reference swap, safe for concurrent readers
+        self.mtime = mtime
+        print(f"Loaded {len(domains)} blocked domains from {self.path}")
+        return True
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if self.mtime is not None and now - self.last_check < self.check_interval:
+            return
+        # Only one thread checks the file; the rest keep serving the current set
+        if not self.reload_lock.acquire(blocking=False):
+            return
+        try:
+            self.last_check = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                return
+            if mtime != self.mtime:
+                self.reload()
+        finally:
+            self.reload_lock.release()
+
+    def match(self, host):
+        domains = self.domains
+        host = host.lower()
+        while True:
+            if host in domains:
+                return host
+            dot = host.find('.')
+            if dot == -1:
+                return None
+            host = host[dot + 1:]
+
+    # URLs without a valid host are reported as blocked - a link we can't parse
+    # the way a browser would is not one we can vouch for
+    def check_url(self, url):
+        host = extract_host(url) if isinstance(url, str) else None
+        matched = self.match(host) if host else None
+        return {
+            'url': url,
+            'host': host,
+            'blocked': host is None or matched is not None,
+            'invalid': host is None,
+            'matched': matched
+        }
+
+@bp.route('/check_url', methods=['GET'])
+def check_url():
+    url = request.args.get('url', '')
+    if not url:
+        return jsonify({'error': 'url parameter required'}), 400
+    
+    blocklist = app_state().blocklist
+    blocklist.maybe_reload()
+    return jsonify(blocklist.check_url(url)), 200
+
+@bp.route('/check_urls', methods=['POST'])
+def check_urls():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    urls = data.get('urls')
+    only_blocked = data.get('only_blocked', False)
+    
+    if not isinstance(urls, list):
+        return jsonify({'error': 'urls must be a list'}), 400
+    if len(urls) > CHECK_URLS_MAX:
+        return jsonify({'error': f'At most {CHECK_URLS_MAX} URLs per request'}), 413
+    
+    blocklist = app_state().blocklist
+    blocklist.maybe_reload()
+    results = []
+    blocked_count = 0
+    for url in urls:
+        result = blocklist.check_url(url)
+        if result['blocked']:
+            blocked_count += 1
+        elif only_blocked:
+            continue
+        results.append(result)
+    
+    return jsonify({
+        'checked': len(urls),
+        'blocked_count': blocked_count,
+        'results': results
+    }), 200
+
+def check_version(client_version):
     if client_version != APP_VERSION:
-        return jsonify({
+        return {
             'error': 'Version mismatch',
             'server_version': APP_VERSION,
             'client_version': client_version,
             'message': f'Client version {client_version} does not match server version {APP_VERSION}. Please update your client.'
-        }), 426  # Upgrade Required
+        }, 426  # Upgrade Required
+    
+    return {'message': 'Version compatible', 'version': APP_VERSION}, 200
+
+@bp.route('/version_check', methods=['POST'])
+def version_check():
+    data = request.get_json()
+    body, status = check_version(data.get('version', ''))
+    return jsonify(body), status
+
+SYNC_MAX_OPS = 20  # Max operations per /sync request
+
+# One round-trip for everything a connected client does on its timers:
+#   {"ops": [{"op": "version_check", "version": "2.0.0"},
+#            {"op": "activity_ping"},
+#            {"op": "award_passive_coin"},
+#            {"op": "save_passive_progress", "passive_progress": "..."},
+#            {"op": "get_pending_actions"},
+#            {"op": "mark_action_executed", "action_id": 12}]}
+# Ops run in order against one connection and are committed together. Each op
+# keeps the rules of its standalone endpoint (rate limits included) and gets its
+# own entry in "results" with the status that endpoint would have returned.
+@bp.route('/sync', methods=['POST'])
+def sync():
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    ops = data.get('ops')
+    if not isinstance(ops, list) or not ops:
+        return jsonify({'error': 'ops must be a non-empty list'}), 400
+    if len(ops) > SYNC_MAX_OPS:
+        return jsonify({'error': f'At most {SYNC_MAX_OPS} ops per sync'}), 413
+    
+    username = session['username']
+    current_time = datetime.now()
+    
+    conn = connect_user(username)
+    c = conn.cursor()
+    results = []
+    
+    try:
+        for op in ops:
+            name = op.get('op') if isinstance(op, dict) else None
+            if name == 'version_check':
+                body, status = check_version(op.get('version', ''))
+            elif name == 'activity_ping':
+                body, status = record_activity_ping(c, username, current_time)
+            elif name == 'award_passive_coin':
+                body, status = award_passive(c, username, current_time)
+            elif name == 'save_passive_progress':
+                body, status = store_passive_progress(c, username, op.get('passive_progress'))
+            elif name == 'get_pending_actions':
+                body, status = fetch_pending_actions(c, username)
+            elif name == 'mark_action_executed':
+                body, status = set_action_executed(c, username, op.get('action_id'))
+            else:
+                body, status = {'error': f'Unknown op: {name}'}, 400
+            results.append({'op': name, 'status': status, 'body': body})
+        
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
+    return jsonify({'results': results}), 200
+
+# Rebalance from one shard layout to another, e.g. one users.db into 4 shards:
+#   python server.py migrate_shards 1 4
+# Run it with the server stopped, then restart with SERVER_SHARD_COUNT=4.
+# The old files are left untouched so they can be removed by hand afterwards.
+def migrate_shards(old_count, new_count):
+    if old_count < 1 or new_count < 1 or old_count == new_count:
+        raise ValueError('Shard counts must be positive and different')
+    for index in range(new_count):
+        path = shard_db_path(index, new_count)
+        if os.path.exists(path):
+            raise ValueError(f'{path} already exists')
+    
+    init_db(old_count)  # Upgrades old schemas and settles pending cross-shard purchases
+    init_db(new_count)
+    
+    targets = [connect_shard(index, new_count) for index in range(new_count)]
+    copied = dict.fromkeys(SHARD_OWNER_COLUMNS, 0)
+    try:
+        for index in range(old_count):
+            source = connect_shard(index, old_count)
+            for table, owner_column in SHARD_OWNER_COLUMNS.items():
+                sc = source.execute(f'SELECT * FROM {table}')
+                columns = [d[0] for d in sc.description]
+                # Integer ids from different old shards can collide, so they are
+                # only kept when splitting a single database
+                if old_count > 1 and table != 'transfer_ledger':
+                    keep = [i for i, column in enumerate(columns) if column != 'id']
+                else:
+                    keep = list(range(len(columns)))
+                owner = columns.index(owner_column)
+                insert = (f"INSERT INTO {table} ({', '.join(columns[i] for i in keep)}) "
+                          f"VALUES ({', '.join('?' for _ in keep)})")
+                
+                while True:
+                    rows = sc.fetchmany(5000)
+                    if not rows:
+                        break
+                    by_shard = {}
+                    for row in rows:
+                        by_shard.setdefault(shard_for(row[owner], new_count), []).append(
+                            [row[i] for i in keep])
+                    for target_index, shard_rows in by_shard.items():
+                        targets[target_index].executemany(insert, shard_rows)
+                    copied[table] += len(rows)
+                
+                for target in targets:
+                    target.commit()
+            source.close()
+    finally:
+        for target in targets:
+            target.close()
     
-    return jsonify({'message': 'Version compatible', 'version': APP_VERSION}), 200
+    print(f"Migrated {old_count} -> {new_count} shards: {copied}")
+    return copied
+
+# Top earners' catalogs are the most requested ones, so they are cached first
+def prewarm_catalogs(count):
+    if count <= 0 or current_app.config['CATALOG_CACHE_TTL'] <= 0:
+        return 0
+    
+    sellers = []
+    for index in range(shard_count()):
+        conn = connect_shard(index)
+        c = conn.cursor()
+        c.execute("SELECT username, earnings_cents FROM users ORDER BY earnings_cents DESC LIMIT ?", (count,))
+        sellers.extend(c.fetchall())
+        conn.close()
     
-    return jsonify({'message': 'Version compatible', 'version': APP_VERSION}), 200
+    sellers.sort(key=lambda seller: seller[1], reverse=True)
+    for username, _ in sellers[:count]:
+        get_catalog(username)
+    return min(len(sellers), count)
+
+# Everything the server needs before it is "ready": every shard's schema, settled
+# cross-shard purchases, the blocklist and (optionally) cached catalogs.
+# Requests are served while this runs; anything they touch is initialized on demand.
+def warm_up(app):
+    state = app.extensions['server']
+    started = time.monotonic()
+    with app.app_context():
+        try:
+            init_db()
+            state.blocklist.maybe_reload()
+            prewarmed = prewarm_catalogs(app.config['PREWARM_TOP_SELLERS'])
+        except Exception as e:
+            state.warm_up_error = str(e)
+            state.warm_up_thread = None  # Try again on the next request
+            print(f"Warm-up failed: {e}")
+            return
+    
+    state.warm_up_error = None
+    state.ready.set()
+    print(f"Warm-up finished in {time.monotonic() - started:.2f}s ({prewarmed} catalogs cached)")
+
+@bp.before_app_request
+def start_warm_up():
+    state = app_state()
+    if state.warm_up_thread is not None or state.ready.is_set():
+        return
+    with state.warm_up_lock:
+        if state.warm_up_thread is None and not state.ready.is_set():
+            state.warm_up_thread = threading.Thread(
+                target=warm_up, args=(current_app._get_current_object(),), daemon=True)
+            state.warm_up_thread.start()
+
+@bp.route('/health', methods=['GET'])
+def health():
+    return jsonify({
+        'status': 'ok',
+        'version': APP_VERSION,
+        'ready': app_state().ready.is_set()
+    }), 200
+
+@bp.route('/ready', methods=['GET'])
+def ready():
+    state = app_state()
+    if state.ready.is_set():
+        return jsonify({'ready': True}), 200
+    return jsonify({'ready': False, 'error': state.warm_up_error}), 503
+
+# App factory - cheap to call, all database work happens lazily after startup
+def create_app(config=None):
+    app = Flask(__name__)
+    app.json = FastJSONProvider(app)
+    
+    app.config.update(DEFAULT_CONFIG)
+    config_file = os.environ.get('SERVER_CONFIG_FILE')
+    if config_file:
+        app.config.from_file(config_file, load=json.load)
+    app.config.from_prefixed_env('SERVER')
+    if config:
+        app.config.update(config)
+    if not app.config['SECRET_KEY']:
+        app.config['SECRET_KEY'] = secrets.token_hex(16)  # Generate a random secret key
+    
+    app.extensions['server'] = AppState(app)
+    if not app.config['WARM_UP']:
+        app.extensions['server'].ready.set()
+    app.register_blueprint(bp)
+    return app
+
+# For WSGI servers pointed at server:app
+app = create_app()
 
 if __name__ == '__main__':
-    init_db()
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    if len(sys.argv) == 4 and sys.argv[1] == 'migrate_shards':
+        with app.app_context():
+            migrate_shards(int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file